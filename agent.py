@@ -1,8 +1,13 @@
 # agent.py
-from typing import Dict, Any, Tuple, Optional
+from typing import Dict, Any, Tuple, Optional, Iterator, Union
+from concurrent.futures import ThreadPoolExecutor, Future
 import re
 import datetime
 import logging
+import threading
+
+from cachetools import TTLCache
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 import config
 import llm_services
@@ -10,91 +15,173 @@ import rag_processor
 import utils
 from utils import parse_number_from_string, compute_emi_schedule
 
-# Setup logger
+# Setup logger (basicConfig is a no-op if logging is already configured)
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s: %(message)s")
 logger = logging.getLogger("agent")
-if not logger.handlers:
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter("[%(asctime)s] %(levelname)s: %(message)s")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-logger.setLevel(logging.INFO)
+
+# Handlers reply with text, or a token iterator when a RAG answer is streamed
+Reply = Union[str, Iterator[str]]
+
+# Shared pool for overlapping independent I/O (e.g. intent LLM + retrieval)
+_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="agent")
+
+# ---------------------------
+# PRECOMPILED PATTERNS
+# ---------------------------
+_WS_RE = re.compile(r"\s+")
+_DOB_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+_PIN_RE = re.compile(r"^\d{6}$")
+_PHONE_RE = re.compile(r"^\d{10}$")
+_EMAIL_RE = re.compile(r"^[\w\.-]+@[\w\.-]+\.\w+$")
+_EMI_VAL_RE = re.compile(r"^\s*[\d\.,]+\s*(lakh|lakhs|lac|lacs|cr|crore|k|years|yrs|%)?\s*$")
+_ELIG_VAL_RE = re.compile(r"^\s*[\d\.,]+\s*(lakh|lakhs|lac|lacs|cr|crore|k)?\s*$")
+_EMI_WORD_RE = re.compile(r"\bemi\b")
+_THANKS_RE = re.compile(r"\b(thank\s*you|thanks|thx)\b", re.I)
+_QUESTION_RE = re.compile(r"^(how|what|why|when|where|tell|give|explain)\b", re.I)
+_FIRST_WORD_RE = re.compile(r"[a-z]+")
+# Yes/no-question openers ("is emi fixed") that is_question doesn't cover;
+# only used for intent shortcuts, so names like "Will Smith" are unaffected
+_YES_NO_QUESTION_RE = re.compile(r"^(is|are|can|could|do|does|should|will|would|which|who)\b", re.I)
 
 # ---------------------------
 # QUESTION DETECTOR
 # ---------------------------
 def is_question(text: str) -> bool:
-    text = text.lower().strip()
-    question_words = ["how", "what", "why", "when", "where", "tell", "give", "explain"]
-    if text.endswith("?"):
-        return True
-    return any(text.startswith(w) for w in question_words)
+    text = text.strip()
+    return text.endswith("?") or bool(_QUESTION_RE.match(text))
+
+# ---------------------------
+# FAST (LOCAL) INTENT
+# ---------------------------
+_AFFIRMATIVE_WORDS = frozenset({"yes", "y", "yup", "yeah", "yep", "sure", "ok", "okay", "proceed"})
+_NEGATIVE_WORDS = frozenset({"no", "n", "nope", "nah", "cancel"})
+_GREETING_WORDS = frozenset({"hi", "hello", "hey"})
+
+# Flows where a message means the same regardless of the previous turn, so
+# the history-free intent.json example match may decide the intent
+_STATELESS_FLOWS = frozenset({"initial", "rag"})
+
+
+def _fast_intent(q: str) -> Optional[str]:
+    """
+    Classifies trivial inputs locally so they don't need an LLM round-trip.
+    Returns None when the query needs the LLM classifier.
+    """
+    ql = q.lower().strip()
+    if ql in _AFFIRMATIVE_WORDS:
+        return "affirmative"
+    if ql in _NEGATIVE_WORDS:
+        return "negative"
+    if ql in _GREETING_WORDS:
+        return "greeting"
+    # "what is emi?" / "is emi fixed" are questions for the classifier,
+    # not requests to start a flow
+    if is_question(ql) or _YES_NO_QUESTION_RE.match(ql):
+        return None
+    if _EMI_WORD_RE.search(ql):
+        return "start_emi"
+    if "eligib" in ql:
+        return "start_eligibility"
+    return None
+
+
+def _explicit_yes_no(q: str) -> Optional[str]:
+    """
+    'affirmative' / 'negative' when the reply opens with a plain Yes/No
+    word ("yes please", "no thanks") and is not itself a question.
+    """
+    if is_question(q):
+        return None
+    first = _FIRST_WORD_RE.search(q.lower())
+    if first is None:
+        return None
+    if first.group(0) in _AFFIRMATIVE_WORDS:
+        return "affirmative"
+    if first.group(0) in _NEGATIVE_WORDS:
+        return "negative"
+    return None
 
 # ---------------------------
 # Public entrypoint
 # ---------------------------
-def agent_controller(query: str, state: Dict[str, Any], vector_db) -> Tuple[str, Dict[str, Any]]:
-    state.setdefault("vector_db", vector_db)
-    state.setdefault("chat_history", state.get("chat_history", []))
+def agent_controller(query: str, state: Dict[str, Any], vector_db) -> Tuple[Reply, Dict[str, Any]]:
+    """
+    Returns (response, state). The response is a str, except for RAG
+    answers which are returned as a token iterator for st.write_stream.
+    """
+    if "vector_db" not in state:
+        state["vector_db"] = vector_db
     q = (query or "").strip()
+    ql = q.lower()
     state["last_user_query"] = q
 
     # THANK YOU HANDLER (mark conversation complete)
-    thank_you_phrases = {"thank you", "thanks", "ok thank you", "okay thank you", "thankyou", "thx"}
-    if q.lower() in thank_you_phrases or any(p in q.lower() for p in thank_you_phrases):
+    if _THANKS_RE.search(q):
         state["conversation_complete"] = True
         return (
             "You're welcome! 😊\n\nIf you need help with EMI, eligibility, or any home-loan policy, feel free to ask.",
             state
         )
 
-    # Intent detection (LLM)
-    try:
-        history = state.get("chat_history", [])
-        intent_data = llm_services.detect_intent_with_llm(q, history)
-        intent = intent_data.get("intent", "ask_rag")
-    except Exception as e:
-        logger.warning(f"Intent detection failed: {e}. Defaulting to ask_rag.")
-        intent = "ask_rag"
+    current_flow = state.setdefault("current_flow", "initial")
+
+    # Intent detection (local fast path, then LLM)
+    intent = _fast_intent(q)
+    ctx_future = None
+    if intent is None and current_flow == "post_emi":
+        # "yes please" / "no thanks" need no LLM; anything else ("sounds good",
+        # "not now", a question) goes to the history-aware classifier below
+        intent = _explicit_yes_no(q)
+    if intent is None:
+        # Inside the RAG flow the likely next step is retrieval, which only
+        # depends on the query → run it while the intent LLM call is in flight
+        if current_flow == "rag" and "emi" not in ql and "eligib" not in ql:
+            ctx_future = _prefetch_rag_context(q, state.get("vector_db"))
+        try:
+            history = state.get("chat_history", [])
+            slot = _CLASSIFIED_SLOTS.get((current_flow, state.get("waiting_for")))
+            classify_future = None
+            if slot and not _is_bare_value(slot[0], q):
+                # Slot-filling turn that will also need the value/other LLM:
+                # run it alongside the intent call; its result lands in
+                # llm_services.llm_cache, so the flow handler's call is a hit
+                classify_future = _EXECUTOR.submit(_safe_classify, slot[0], q, slot[1])
+            try:
+                intent_data = llm_services.detect_intent_with_llm(
+                    q, history, use_local=current_flow in _STATELESS_FLOWS
+                )
+            finally:
+                if classify_future is not None:
+                    classify_future.result()   # _safe_classify never raises
+            intent = intent_data.get("intent", "ask_rag")
+        except Exception as e:
+            logger.warning("Intent detection failed: %s. Defaulting to ask_rag.", e)
+            intent = "ask_rag"
 
     state["intent"] = intent
-    state.setdefault("current_flow", "initial")
-    current_flow = state["current_flow"]
 
     # ROUTER
+    handler = _FLOW_DISPATCH.get(current_flow)
+    if handler is not None:
+        return handler(q, state)
     if current_flow == "initial":
         return _handle_initial(intent, state)
-    if current_flow == "collect_emi":
-        return handle_emi_flow(q, state)
-    if current_flow == "post_emi":
-        return _handle_post_emi(intent, state)
-    if current_flow == "collect_eligibility":
-        return handle_eligibility_flow(q, state)
-    if current_flow == "collect_name":
-        return collect_name(q, state)
-    if current_flow == "collect_phone":
-        return collect_phone(q, state)
-    if current_flow == "collect_email":
-        return collect_email(q, state)
-    if current_flow == "collect_otp":
-        return collect_otp(q, state)
-    if current_flow == "post_flow_info":
-        return post_flow_info(q, state)
     if current_flow == "rag":
 
         # ⭐ Allow restarting EMI from anywhere
-        if intent == "start_emi" or any(x in q.lower() for x in ["emi", "calculate emi", "check my emi", "emi calculation"]):
+        if intent == "start_emi" or "emi" in ql:
             state["current_flow"] = "collect_emi"
             state["waiting_for"] = "principal"
             return "Sure! Please provide your Principal Loan Amount.", state
 
         # ⭐ Allow starting Eligibility from anywhere
-        if intent == "start_eligibility" or "eligib" in q.lower():
+        if intent == "start_eligibility" or "eligib" in ql:
             state["current_flow"] = "collect_eligibility"
             state["waiting_for"] = "income"
             return "Sure! Let's check your eligibility.\n\nPlease provide your Monthly Income.", state
 
-        # Default RAG
-        return handle_rag_flow(q, state.get("vector_db")), state
+        # Default RAG (streamed)
+        return handle_rag_flow_stream(q, state.get("vector_db"), ctx_future), state
 
     state = _reset_flows(state)
     return "I'm sorry, I got confused. Let's start over. How can I help?", state
@@ -130,15 +217,115 @@ def _handle_initial(intent: str, state: Dict[str, Any]) -> Tuple[str, Dict[str,
 # ---------------------------
 # RAG handler
 # ---------------------------
+def _normalize_query(query: str) -> str:
+    return _WS_RE.sub(" ", (query or "").lower().strip())
+
+
+# LRU + TTL of final RAG answers keyed by (normalized query, vector_db).
+# vector_db comes from st.cache_resource, so it is the same object across
+# reruns and sessions and is safe to use as part of the key.
+# A cache object (not functools.lru_cache) so the streaming path can fill it.
+_RAG_CACHE_MAXSIZE = 512
+_RAG_CACHE_TTL_SECONDS = 3600
+_RAG_ANSWERS: "TTLCache[tuple, str]" = TTLCache(maxsize=_RAG_CACHE_MAXSIZE, ttl=_RAG_CACHE_TTL_SECONDS)
+_RAG_ANSWERS_LOCK = threading.Lock()   # TTLCache is not thread-safe
+_RAG_FOLLOWUP = "\n\n**Would you like to calculate your EMI?**"
+
+
+def _rag_cache_get(key: tuple) -> Optional[str]:
+    with _RAG_ANSWERS_LOCK:
+        return _RAG_ANSWERS.get(key)
+
+
+def _rag_cache_put(key: tuple, answer: str):
+    with _RAG_ANSWERS_LOCK:
+        _RAG_ANSWERS[key] = answer
+
+
+def _retrieve(query: str, vector_db) -> Tuple[str, bool]:
+    """
+    (context, ok). When retrieval fails the fallback text stands in as the
+    context and ok is False, so answers built from it are not cached.
+    """
+    try:
+        return rag_processor.get_retrieved_context(query, vector_db), True
+    except rag_processor.RetrievalUnavailable as e:
+        return str(e), False
+
+
 def handle_rag_flow(query: str, vector_db) -> str:
-    context = rag_processor.get_retrieved_context(query, vector_db)
-    return llm_services.get_rag_response(query, context) + "\n\n**Would you like to calculate your EMI?**"
+    # Cache on the normalized query; the LLM gets the user's own wording
+    key = (_normalize_query(query), vector_db)
+    answer = _rag_cache_get(key)
+    if answer is None:
+        context, ok = _retrieve(key[0], vector_db)
+        answer = llm_services.get_rag_response((query or "").strip(), context, cacheable=ok)
+        if ok:
+            _rag_cache_put(key, answer)
+    return answer + _RAG_FOLLOWUP
+
+
+def _stream_rag_answer(query: str, vector_db, suffix: str) -> Iterator[str]:
+    """Streams a RAG answer to an in-flow question, then the flow's re-prompt."""
+    context, ok = _retrieve(query, vector_db)
+    yield from llm_services.stream_rag_response(query, context, cacheable=ok)
+    yield suffix
+
+
+def _submit_with_script_ctx(fn, *args) -> Future:
+    """
+    _EXECUTOR.submit for work that reaches st.cache_data / st.cache_resource:
+    the pool thread gets the calling script's ScriptRunContext first, so
+    Streamlit's caches behave as they do on the script thread.
+    """
+    ctx = get_script_run_ctx()
+
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
+
+    return _EXECUTOR.submit(run)
+
+
+def _prefetch_rag_context(query: str, vector_db) -> Optional[Future]:
+    """Starts retrieval in the background unless the answer is already cached."""
+    norm_query = _normalize_query(query)
+    if _rag_cache_get((norm_query, vector_db)) is not None:
+        return None
+    # get_retrieved_context → st.cache_data retrieval + st.cache_resource embeddings
+    return _submit_with_script_ctx(_retrieve, norm_query, vector_db)
+
+
+def handle_rag_flow_stream(query: str, vector_db, ctx_future: Optional[Future] = None) -> Iterator[str]:
+    """
+    Streaming variant of handle_rag_flow for st.write_stream.
+    Cached answers are yielded in one piece; misses stream token chunks
+    and are cached once complete (unless retrieval failed). The EMI
+    prompt follows the answer.
+    ctx_future: _retrieve already started by _prefetch_rag_context.
+    """
+    key = (_normalize_query(query), vector_db)
+    answer = _rag_cache_get(key)
+    if answer is not None:
+        yield answer
+    else:
+        if ctx_future is not None:
+            context, ok = ctx_future.result()
+        else:
+            context, ok = _retrieve(key[0], vector_db)
+        parts = []
+        for chunk in llm_services.stream_rag_response((query or "").strip(), context, cacheable=ok):
+            parts.append(chunk)
+            yield chunk
+        if ok:
+            _rag_cache_put(key, "".join(parts))
+    yield _RAG_FOLLOWUP
 
 
 # ---------------------------
 # EMI Flow
 # ---------------------------
-def handle_emi_flow(query: str, state: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+def handle_emi_flow(query: str, state: Dict[str, Any]) -> Tuple[Reply, Dict[str, Any]]:
     waiting = state.get("waiting_for")
 
     if waiting == "principal":
@@ -151,10 +338,7 @@ def handle_emi_flow(query: str, state: Dict[str, Any]) -> Tuple[str, Dict[str, A
                 return "Got it. What is the **Loan Tenure** (in years)?", state
             return "Please provide a valid principal.", state
 
-        ctx = rag_processor.get_retrieved_context(query, state.get("vector_db"))
-        ans = llm_services.get_rag_response(query, ctx)
-        ans += "\n\nPlease provide the principal amount."
-        return ans, state
+        return _stream_rag_answer(query, state.get("vector_db"), "\n\nPlease provide the principal amount."), state
 
     if waiting == "tenure":
         classification = safe_classify_emi_input(query, "tenure")
@@ -166,10 +350,7 @@ def handle_emi_flow(query: str, state: Dict[str, Any]) -> Tuple[str, Dict[str, A
                 return "Great. What is the **Rate of Interest (ROI)**?", state
             return "Please provide a valid tenure between 1–30 years.", state
 
-        ctx = rag_processor.get_retrieved_context(query, state.get("vector_db"))
-        ans = llm_services.get_rag_response(query, ctx)
-        ans += "\n\nPlease provide the tenure."
-        return ans, state
+        return _stream_rag_answer(query, state.get("vector_db"), "\n\nPlease provide the tenure."), state
 
     if waiting == "roi":
         classification = safe_classify_emi_input(query, "interest rate")
@@ -208,10 +389,7 @@ def handle_emi_flow(query: str, state: Dict[str, Any]) -> Tuple[str, Dict[str, A
 
             return "Please provide a valid interest rate.", state
 
-        ctx = rag_processor.get_retrieved_context(query, state.get("vector_db"))
-        ans = llm_services.get_rag_response(query, ctx)
-        ans += "\n\nPlease provide ROI."
-        return ans, state
+        return _stream_rag_answer(query, state.get("vector_db"), "\n\nPlease provide ROI."), state
 
     return "Sorry, let's restart the EMI flow.", state
 
@@ -219,6 +397,11 @@ def handle_emi_flow(query: str, state: Dict[str, Any]) -> Tuple[str, Dict[str, A
 # ---------------------------
 # POST EMI
 # ---------------------------
+def _post_emi_rag_answer(query: str, vector_db) -> Iterator[str]:
+    yield from handle_rag_flow_stream(query, vector_db)
+    yield "\n\nPlease answer Yes or No."
+
+
 def _handle_post_emi(intent: str, state: Dict[str, Any]):
     """
     Handles Yes/No after EMI. 
@@ -229,13 +412,11 @@ def _handle_post_emi(intent: str, state: Dict[str, Any]):
 
     # CASE 1: User asks another RAG question (NOT yes/no)
     if intent not in ["affirmative", "negative"]:
-        query = state.get("last_user_query", "")
-        rag_answer = handle_rag_flow(query, state.get("vector_db"))
-
         # Stay inside post_emi
         state["current_flow"] = "post_emi"
 
-        return rag_answer + "\n\nPlease answer Yes or No.", state
+        query = state.get("last_user_query", "")
+        return _post_emi_rag_answer(query, state.get("vector_db")), state
 
     # CASE 2: YES → begin eligibility
     if intent == "affirmative":
@@ -256,12 +437,12 @@ def _handle_post_emi(intent: str, state: Dict[str, Any]):
 # ---------------------------
 # ELIGIBILITY FLOW (FULL NAME ADDED)
 # ---------------------------
-def handle_eligibility_flow(query: str, state: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+def handle_eligibility_flow(query: str, state: Dict[str, Any]) -> Tuple[Reply, Dict[str, Any]]:
     waiting = state.get("waiting_for")
+    ql = (query or "").lower()
 
     def rag_with(msg: str):
-        ctx = rag_processor.get_retrieved_context(query, state.get("vector_db"))
-        return llm_services.get_rag_response(query, ctx) + f"\n\n{msg}", state
+        return _stream_rag_answer(query, state.get("vector_db"), f"\n\n{msg}"), state
 
     # 1. income
     if waiting == "income":
@@ -285,10 +466,9 @@ def handle_eligibility_flow(query: str, state: Dict[str, Any]) -> Tuple[str, Dic
 
     # 3. employment
     if waiting == "employment_type":
-        q = query.lower()
-        if "salaried" in q:
+        if "salaried" in ql:
             state["employment_type"] = "Salaried"
-        elif "self" in q:
+        elif "self" in ql:
             state["employment_type"] = "Self-Employed"
         else:
             return rag_with("Please specify Salaried or Self-Employed.")
@@ -297,7 +477,7 @@ def handle_eligibility_flow(query: str, state: Dict[str, Any]) -> Tuple[str, Dic
 
     # 4. dob
     if waiting == "dob":
-        if re.match(r"^\d{4}-\d{2}-\d{2}$", query):
+        if _DOB_RE.match(query):
             state["dob"] = query
             state["waiting_for"] = "pin_code"
             return "Thanks. What is your **Pincode**?", state
@@ -305,7 +485,7 @@ def handle_eligibility_flow(query: str, state: Dict[str, Any]) -> Tuple[str, Dic
 
     # 5. Pincode
     if waiting == "pin_code":
-        if re.match(r"^\d{6}$", query.strip()):
+        if _PIN_RE.match(query.strip()):
             state["pin_code"] = query
             state["waiting_for"] = "loan_type"
             return "Is this for a **Fresh Loan** or a **Balance Transfer**?", state
@@ -313,10 +493,9 @@ def handle_eligibility_flow(query: str, state: Dict[str, Any]) -> Tuple[str, Dic
 
     # 6. loan type
     if waiting == "loan_type":
-        q = query.lower()
-        if "fresh" in q:
+        if "fresh" in ql:
             state["loan_type"] = "Fresh"
-        elif "balance" in q or "transfer" in q:
+        elif "balance" in ql or "transfer" in ql:
             state["loan_type"] = "Balance Transfer"
         else:
             return rag_with("Please specify Fresh Loan or Balance Transfer.")
@@ -334,10 +513,7 @@ def handle_eligibility_flow(query: str, state: Dict[str, Any]) -> Tuple[str, Dic
 
         # If user is asking a question → answer via RAG first
         if is_question(query):
-            ctx = rag_processor.get_retrieved_context(query, state.get("vector_db"))
-            ans = llm_services.get_rag_response(query, ctx)
-            ans += "\n\nPlease enter your full name (e.g., Rohan Sharma)."
-            return ans, state
+            return _stream_rag_answer(query, state.get("vector_db"), "\n\nPlease enter your full name (e.g., Rohan Sharma)."), state
 
         # Validate exact 2-word name
         name_parts = query.strip().split()
@@ -352,7 +528,7 @@ def handle_eligibility_flow(query: str, state: Dict[str, Any]) -> Tuple[str, Dic
 
     # 8. PHONE
     if waiting == "phone":
-        if re.match(r"^\d{10}$", query):
+        if _PHONE_RE.match(query):
             state["phone"] = query
             state["waiting_for"] = "email"
             state["current_flow_before_email"] = "eligibility_flow"
@@ -362,7 +538,7 @@ def handle_eligibility_flow(query: str, state: Dict[str, Any]) -> Tuple[str, Dic
     # 9. EMAIL
     if waiting == "email":
         email = query.strip().lower()
-        if not re.match(r"^[\w\.-]+@[\w\.-]+\.\w+$", email):
+        if not _EMAIL_RE.match(email):
             return rag_with("Please enter a valid email.")
         state["email"] = email
         state["otp_mode"] = "eligibility"
@@ -391,10 +567,7 @@ def collect_name(query, state):
 
     # If user asks a RAG question → answer first
     if is_question(query):
-        ctx = rag_processor.get_retrieved_context(query, state.get("vector_db"))
-        ans = llm_services.get_rag_response(query, ctx)
-        ans += "\n\nPlease enter your full name (e.g., Neha Sharma)."
-        return ans, state
+        return _stream_rag_answer(query, state.get("vector_db"), "\n\nPlease enter your full name (e.g., Neha Sharma)."), state
 
     # Exact 2-word full name required
     name_parts = query.strip().split()
@@ -411,7 +584,7 @@ def collect_name(query, state):
 # PHONE (generic)
 # ---------------------------
 def collect_phone(query: str, state: Dict[str, Any]):
-    if re.match(r"^\d{10}$", query):
+    if _PHONE_RE.match(query):
         state["phone"] = query
         if state.get("current_flow_before_email") is None:
             state["current_flow_before_email"] = "contact_flow"
@@ -427,7 +600,7 @@ def collect_phone(query: str, state: Dict[str, Any]):
 # ---------------------------
 def collect_email(query: str, state: Dict[str, Any]):
     email = query.strip()
-    if not re.match(r"^[\w\.-]+@[\w\.-]+\.\w+$", email):
+    if not _EMAIL_RE.match(email):
         return "Please provide a valid email address.", state
 
     state["email"] = email
@@ -519,18 +692,24 @@ def collect_otp(query: str, state: Dict[str, Any]):
 # Post Flow Info
 # ---------------------------
 def post_flow_info(query: str, state: Dict[str, Any]):
-    try:
-        intent_data = llm_services.detect_intent_with_llm(query, state.get("chat_history", []))
-        intent = intent_data.get("intent", None)
-    except Exception:
-        intent = None
+    ql = (query or "").lower()
+    intent = _fast_intent(query)
+    if intent is None:
+        try:
+            # Yes/No to the previous turn's question: needs the history-aware LLM
+            intent_data = llm_services.detect_intent_with_llm(
+                query, state.get("chat_history", []), use_local=False
+            )
+            intent = intent_data.get("intent", None)
+        except Exception:
+            intent = None
 
-    if intent == "affirmative" or query.lower() in {"yes", "y", "sure"}:
+    if intent == "affirmative" or ql in {"yes", "y", "sure"}:
         state["current_flow"] = "collect_name"
         state["waiting_for"] = "name"
         return "Great! May I know your **Full Name** (e.g., Rohan Sharma)?", state
 
-    if intent == "negative" or query.lower() in {"no", "n"}:
+    if intent == "negative" or ql in {"no", "n"}:
         state["current_flow"] = "rag"
         state["waiting_for"] = None
         return "Alright. Anything else I can help you with?", state
@@ -541,25 +720,27 @@ def post_flow_info(query: str, state: Dict[str, Any]):
 # ---------------------------
 # CLEAR & RESET HELPERS
 # ---------------------------
+_EMI_ELIG_KEYS = frozenset((
+    "principal", "tenure", "roi",
+    "income", "expense", "employment_type", "dob", "pin_code", "loan_type",
+    "customer_name",
+    "phone", "email",
+    "generated_otp", "otp_mode", "current_flow_before_email",
+    "emi_result", "emi_summary", "eligibility_result"
+))
+_PRESERVED_KEYS = ("session_id", "chat_history", "vector_db")
+
+
 def _clear_emi_and_eligibility(state: Dict[str, Any]):
-    keys = [
-        "principal", "tenure", "roi",
-        "income", "expense", "employment_type", "dob", "pin_code", "loan_type",
-        "customer_name",
-        "phone", "email",
-        "generated_otp", "otp_mode", "current_flow_before_email",
-        "emi_result", "emi_summary", "eligibility_result"
-    ]
-    for k in keys:
-        state.pop(k, None)
+    # Intersection only touches keys that are actually present
+    for k in _EMI_ELIG_KEYS & state.keys():
+        del state[k]
 
 
 def _reset_flows(state: Dict[str, Any]) -> Dict[str, Any]:
-    preserved = {
-        "session_id": state.get("session_id"),
-        "chat_history": state.get("chat_history", []),
-        "vector_db": state.get("vector_db")
-    }
+    preserved = {k: state.get(k) for k in _PRESERVED_KEYS}
+    if preserved["chat_history"] is None:
+        preserved["chat_history"] = []
     state.clear()
     state.update({
         "current_flow": "initial",
@@ -574,22 +755,62 @@ def _reset_flows(state: Dict[str, Any]) -> Dict[str, Any]:
 # ---------------------------
 # SAFE CLASSIFIERS
 # ---------------------------
-def safe_classify_emi_input(query: str, waiting_for: str) -> str:
+_CLASSIFY_VALUE_RE = {"emi": _EMI_VAL_RE, "elig": _ELIG_VAL_RE}
+_CLASSIFY_LLM = {
+    "emi": llm_services.classify_emi_input,
+    "elig": llm_services.classify_eligibility_input,
+}
+_CLASSIFY_VALUE_WORDS = {"emi": frozenset(), "elig": frozenset({"0", "none", "no expenses"})}
+
+# (current_flow, waiting_for) → (classifier kind, field name the flow handler passes)
+_CLASSIFIED_SLOTS = {
+    ("collect_emi", "principal"): ("emi", "principal"),
+    ("collect_emi", "tenure"): ("emi", "tenure"),
+    ("collect_emi", "roi"): ("emi", "interest rate"),
+    ("collect_eligibility", "income"): ("elig", "income"),
+    ("collect_eligibility", "expense"): ("elig", "expense"),
+}
+
+
+def _is_bare_value(kind: str, query: str) -> bool:
+    return bool(
+        _CLASSIFY_VALUE_RE[kind].match(query.lower())
+        or query.strip() in _CLASSIFY_VALUE_WORDS[kind]
+    )
+
+
+def _safe_classify(kind: str, query: str, field: str) -> str:
+    """
+    value/other classification. kind: 'emi' | 'elig'.
+    Bare values ("50000", "20 years", "8.5%") are decided locally;
+    only natural-language input goes to the LLM.
+    """
+    if _is_bare_value(kind, query):
+        return "value"
     try:
-        return llm_services.classify_emi_input(query, waiting_for)
+        return _CLASSIFY_LLM[kind](query, field)
     except Exception:
-        if re.search(r"^\s*[\d\.,]+\s*(lakh|lakhs|lac|lacs|cr|crore|k|years|yrs|%)?\s*$", query.lower()):
-            return "value"
         return "other"
 
 
+def safe_classify_emi_input(query: str, waiting_for: str) -> str:
+    return _safe_classify("emi", query, waiting_for)
+
+
 def safe_classify_eligibility_input(query: str, field: str) -> str:
-    try:
-        return llm_services.classify_eligibility_input(query, field)
-    except Exception:
-        if (
-            re.search(r"^\s*[\d\.,]+\s*(lakh|lakhs|lac|lacs|cr|crore|k)?\s*$", query.lower())
-            or query.strip() in {"0", "none", "no expenses"}
-        ):
-            return "value"
-        return "other"
+    return _safe_classify("elig", query, field)
+
+
+# ---------------------------
+# FLOW DISPATCH TABLE
+# ---------------------------
+_FLOW_DISPATCH = {
+    "collect_emi": handle_emi_flow,
+    "post_emi": lambda q, s: _handle_post_emi(s["intent"], s),
+    "collect_eligibility": handle_eligibility_flow,
+    "collect_name": collect_name,
+    "collect_phone": collect_phone,
+    "collect_email": collect_email,
+    "collect_otp": collect_otp,
+    "post_flow_info": post_flow_info,
+}
@@ -6,6 +6,7 @@ import json
 import config
 import utils
 import rag_processor
+import llm_services
 import agent 
 
 # ------------------------------------------------------
@@ -32,6 +33,21 @@ except Exception as e:
     vector_db = None
 
 
+# ------------------------------------------------------
+# WARM UP GEMINI CLIENT (once per process)
+# ------------------------------------------------------
+@st.cache_resource(show_spinner=False)
+def _warmup_llm() -> bool:
+    try:
+        llm_services.warmup()
+        return True
+    except Exception as e:
+        print(f"LLM warmup failed: {e}")
+        return False
+
+_warmup_llm()
+
+
 # ------------------------------------------------------
 # SESSION INITIALIZATION
 # ------------------------------------------------------
@@ -41,6 +57,10 @@ if "session_id" not in st.session_state:
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
 
+# EMI schedule DataFrames, keyed by chat_history index (built once per message)
+if "emi_schedule_frames" not in st.session_state:
+    st.session_state.emi_schedule_frames = {}
+
 if "app_state" not in st.session_state:
     st.session_state.app_state = {
         "current_flow": "initial",
@@ -85,16 +105,26 @@ if not st.session_state.chat_history:
     st.session_state.chat_history.append({"role": "assistant", "content": welcome_msg})
 
 
+# ------------------------------------------------------
+# EMI SCHEDULE TABLE (memoised per message across reruns)
+# ------------------------------------------------------
+def _emi_schedule_frame(msg_index: int, schedule) -> pd.DataFrame:
+    frames = st.session_state.emi_schedule_frames
+    if msg_index not in frames:
+        frames[msg_index] = pd.DataFrame(schedule)
+    return frames[msg_index]
+
+
 # ------------------------------------------------------
 # DISPLAY CHAT HISTORY
 # ------------------------------------------------------
-for msg in st.session_state.chat_history:
+for idx, msg in enumerate(st.session_state.chat_history):
     with st.chat_message(msg["role"]):
         st.markdown(msg["content"])
 
         # Show EMI schedule only when attached
         if msg.get("display_emi"):
-            df = pd.DataFrame(msg["display_emi"]["schedule"])
+            df = _emi_schedule_frame(idx, msg["display_emi"]["schedule"])
             with st.expander(f"📅 EMI Schedule ({len(df)} months)"):
                 st.dataframe(df)
 
@@ -128,6 +158,12 @@ if user_input:
 
                 st.session_state.app_state = updated_state
 
+                # RAG answers arrive as a token stream
+                if isinstance(bot_response, str):
+                    st.markdown(bot_response)
+                else:
+                    bot_response = st.write_stream(bot_response)
+
                 response_entry = {
                     "role": "assistant",
                     "content": bot_response,
@@ -142,11 +178,12 @@ if user_input:
                     response_entry["display_emi"] = updated_state["emi_result"]
                     updated_state["show_emi_once"] = False   # <-- STOP FUTURE AUTO-DISPLAYS
 
-                st.markdown(bot_response)
-
                 # Show EMI schedule in UI
                 if response_entry.get("display_emi"):
-                    df = pd.DataFrame(response_entry["display_emi"]["schedule"])
+                    df = _emi_schedule_frame(
+                        len(st.session_state.chat_history),
+                        response_entry["display_emi"]["schedule"]
+                    )
                     with st.expander(f"📅 EMI Schedule ({len(df)} months)"):
                         st.dataframe(df)
 
@@ -160,10 +197,10 @@ if user_input:
                 })
 
     # ------------------------------------------------------
-    # SAVE TO BIGQUERY
+    # SAVE TO BIGQUERY (background worker, does not block the reply)
     # ------------------------------------------------------
     try:
-        utils.save_to_bigquery(
+        utils.enqueue_save_to_bigquery(
             st.session_state.session_id,
             st.session_state.chat_history,
             st.session_state.app_state
@@ -26,6 +26,35 @@ PDF_FILES = [
 RAG_CHUNK_SIZE = 1500
 RAG_CHUNK_OVERLAP = 200
 RAG_TOP_K = 5
+RAG_EMBED_BATCH_SIZE = 100
+# Built index is saved here and reused until the PDFs or embedding model change
+FAISS_INDEX_DIR = "faiss_index"
+# HNSW graph index: neighbours per node, build-time and query-time breadth (recall vs latency)
+FAISS_HNSW_M = 32
+FAISS_HNSW_EF_CONSTRUCTION = 200
+FAISS_HNSW_EF_SEARCH = 64
+# Stored vector precision: None for exact float32 (default), "fp16" (half size)
+# or "8bit" (quarter size). Only switch after checking recall@k against float32.
+FAISS_QUANTIZATION = None
+# Retrieved context is reused for repeated (normalized) queries for this long
+RAG_CONTEXT_CACHE_TTL_SECONDS = 1800
+
+# --- Intent detection ---
+# Only the most recent messages are sent to the intent LLM
+INTENT_HISTORY_WINDOW = 6
+# Cosine similarity needed to accept the nearest intent.json example without the LLM
+INTENT_SIMILARITY_THRESHOLD = 0.92
+# Otherwise the k nearest examples vote (similarity-weighted); the winning intent
+# needs this share of the vote, and the nearest example this similarity
+INTENT_KNN_K = 5
+INTENT_MIN_PROBABILITY = 0.6
+INTENT_KNN_MIN_SIMILARITY = 0.80
+# The vote is only used if it reaches this leave-one-out accuracy on intent.json
+INTENT_KNN_MIN_ACCURACY = 0.9
+
+# --- LLM response cache ---
+LLM_CACHE_MAXSIZE = 10_000
+LLM_CACHE_TTL_SECONDS = 3600
 
 # --- OTP ---
 MOCK_OTP_CODE = "123456"
@@ -0,0 +1,43 @@
+# llm_cache.py
+import hashlib
+import json
+import threading
+from typing import Any, Callable, Dict
+
+from cachetools import TTLCache
+
+
+class LLMCache:
+    """
+    In-process LRU + TTL cache for LLM responses.
+    Keys are sha256 of (template name, inputs); the 'query' input is
+    stripped and lowercased first so trivial variations share an entry.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: int = 3600):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()   # TTLCache is not thread-safe
+
+    @staticmethod
+    def cache_key(template_name: str, inputs: Dict[str, Any]) -> str:
+        inputs = dict(inputs)
+        if isinstance(inputs.get("query"), str):
+            inputs["query"] = inputs["query"].strip().lower()
+        raw = json.dumps({"t": template_name, "i": inputs}, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            return self._cache.get(key)
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._cache[key] = value
+
+    def get_or_set(self, key: str, compute: Callable[[], Any]) -> Any:
+        """Returns the cached value, or computes and stores it (errors are not cached)."""
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value)
+        return value
@@ -1,8 +1,12 @@
 # llm_services.py
 import json
 import re
+import functools
 import utils
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple, Iterator, Optional
+
+import faiss
+import numpy as np
 
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate
@@ -10,12 +14,17 @@ from langchain_core.output_parsers import StrOutputParser
 
 import config
 import prompts
-from google.auth import default
-credentials, project = default()
+import rag_processor
+from llm_cache import LLMCache
+
+# Same service-account credentials object as the embeddings client, so
+# both share one token and refresh cycle
+credentials = rag_processor.credentials
 
 # --- LLM Initialization ---
+@functools.lru_cache(maxsize=1)
 def get_llm() -> ChatGoogleGenerativeAI:
-    """Initializes and returns the Gemini LLM instance."""
+    """Returns the process-wide Gemini LLM instance (created on first call)."""
     return ChatGoogleGenerativeAI(
         model=config.MODEL_NAME,
         credentials=credentials,   # ✅ FIXED
@@ -24,36 +33,282 @@ def get_llm() -> ChatGoogleGenerativeAI:
 
 llm = get_llm()
 
+# --- Chains (built once at import; only the inference RPC runs per call) ---
+def _build_chain(template: str):
+    return ChatPromptTemplate.from_template(template) | llm | StrOutputParser()
+
+intent_chain = _build_chain(prompts.INTENT_PROMPT)
+eligibility_chain = _build_chain(prompts.ELIGIBILITY_PROMPT)
+rag_chain = _build_chain(prompts.RAG_PROMPT)
+classifier_chain = _build_chain("{prompt}")
+
+# --- Response cache (identical inputs → identical prompt → skip the API) ---
+llm_cache = LLMCache(maxsize=config.LLM_CACHE_MAXSIZE, ttl=config.LLM_CACHE_TTL_SECONDS)
+
+
+def _cached_invoke(name: str, chain, inputs: Dict[str, Any], key_inputs: Optional[Dict[str, Any]] = None) -> str:
+    """chain.invoke(inputs) through llm_cache; key_inputs overrides what the key is built from."""
+    key = LLMCache.cache_key(name, inputs if key_inputs is None else key_inputs)
+    return llm_cache.get_or_set(key, lambda: chain.invoke(inputs))
+
+
+def warmup():
+    """One tiny request so auth/channel setup happens before the first user turn."""
+    llm.bind(max_output_tokens=1).invoke("ok")   # one output token is enough
+    _intent_index()
+
 # --- Helper to parse dirty JSON from LLM ---
+try:
+    import json_repair   # optional: tolerant parser for malformed/truncated JSON
+except ImportError:
+    json_repair = None
+
+try:
+    import orjson   # optional: faster parse for the common, well-formed case
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+_JSON_RE = re.compile(r'\{.*\}', re.DOTALL)
+_DANGLING_SEP_RE = re.compile(r'[,:]\s*$')
+
+
+def _drop_trailing_comma(out: List[str]):
+    """Removes a ',' (plus following whitespace) from the end of out."""
+    i = len(out) - 1
+    while i >= 0 and out[i].isspace():
+        i -= 1
+    if i >= 0 and out[i] == ",":
+        del out[i]
+
+
+def _close_json(json_str: str) -> Optional[str]:
+    """
+    Appends the brackets a cut-off JSON text is missing and drops trailing
+    commas before '}' / ']'. Only characters outside strings are touched,
+    so string values come through unchanged. Returns None if the text was
+    cut inside a string: a half-written value ("start_e") must not pass
+    as a real one.
+    """
+    out, closers, in_string, escaped = [], [], False, False
+    for ch in json_str:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            closers.append("}")
+        elif ch == "[":
+            closers.append("]")
+        elif ch in "}]":
+            _drop_trailing_comma(out)
+            if closers:
+                closers.pop()
+        out.append(ch)
+
+    if in_string:
+        return None
+    json_str = _DANGLING_SEP_RE.sub("", "".join(out))
+    return json_str + "".join(reversed(closers))
+
+
+def _close_truncated_json(json_str: str) -> Any:
+    """
+    Parses truncated output by closing it; if the cut left a half-written
+    member ('"key"', '"key": ' or an unterminated string), drops back one
+    comma at a time.
+    """
+    candidate = json_str
+    while True:
+        closed = _close_json(candidate)
+        if closed is not None:
+            try:
+                return json.loads(closed)
+            except json.JSONDecodeError:
+                pass
+        cut = candidate.rfind(",")
+        if cut <= 0:
+            raise ValueError("Truncated JSON could not be closed")
+        candidate = candidate[:cut]
+
+
+def _repair_json(json_str: str) -> Dict[str, Any]:
+    """Second chance for dirty LLM JSON, instead of another Gemini call."""
+    if json_repair is not None:
+        repaired = json_repair.loads(json_str)
+    else:
+        repaired = _close_truncated_json(json_str)
+    if not isinstance(repaired, dict):
+        raise ValueError("Repaired JSON is not an object")
+    return repaired
+
+
 def parse_llm_json_output(llm_output: str) -> Dict[str, Any]:
     """Tries to find and parse a JSON object from the LLM's string output."""
+    # Find the first '{' and last '}'
+    json_match = _JSON_RE.search(llm_output)
+    if json_match:
+        json_str = json_match.group(0)
+    elif "{" in llm_output:
+        # Truncated output: no closing brace
+        json_str = llm_output[llm_output.index("{"):]
+    else:
+        print(f"Warning: No JSON object found in LLM output: {llm_output}")
+        return {"error": "No JSON object found"}
+
     try:
-        # Find the first '{' and last '}'
-        json_match = re.search(r'\{.*\}', llm_output, re.DOTALL)
-        if json_match:
-            json_str = json_match.group(0)
-            return json.loads(json_str)
-        else:
-            print(f"Warning: No JSON object found in LLM output: {llm_output}")
-            return {"error": "No JSON object found"}
+        # orjson.JSONDecodeError subclasses json.JSONDecodeError
+        return _json_loads(json_str)
     except json.JSONDecodeError as e:
-        print(f"Error: Could not decode JSON from LLM: {e}\nOutput: {llm_output}")
-        return {"error": "JSONDecodeError", "message": str(e)}
+        try:
+            return _repair_json(json_str)
+        except ValueError:
+            print(f"Error: Could not decode JSON from LLM: {e}\nOutput: {llm_output}")
+            return {"error": "JSONDecodeError", "message": str(e)}
 
 # --- 1. Intent Detection Service (Requirement 6) ---
-def detect_intent_with_llm(query: str, history: List[Dict[str, str]]) -> Dict[str, Any]:
-    """Detects intent using the LLM based on query and history."""
-    history_str = "\n".join([f"{msg['role']}: {msg['content']}" for msg in history])
-    
-    prompt_template = ChatPromptTemplate.from_template(prompts.INTENT_PROMPT)
-    chain = prompt_template | llm | StrOutputParser()
-    
-    response = chain.invoke({
-        "history": history_str,
-        "query": query
-    })
-    
-    return parse_llm_json_output(response)
+_GREETING_RE = re.compile(r"^(hi|hello|hey)( there)?\W*$")
+_INTENT_LABELS = frozenset(item["intent"] for item in prompts.INTENT_EXAMPLES.get("intents", []))
+
+
+@functools.lru_cache(maxsize=1)
+def _intent_index() -> Optional[Tuple[faiss.IndexFlatIP, List[str], bool]]:
+    """
+    Embeds every intent.json example once; returns (cosine index, labels,
+    whether the kNN vote passed its leave-one-out check), or None when the
+    examples can't be embedded. The None is cached as well, so a failing
+    embeddings client costs one attempt per process, not one per turn.
+    """
+    labels, texts = [], []
+    for item in prompts.INTENT_EXAMPLES.get("intents", []):
+        for example in item.get("examples", []):
+            labels.append(item["intent"])
+            texts.append(example.lower().strip())
+
+    try:
+        vectors = np.asarray(rag_processor.get_embeddings().embed_documents(texts), dtype="float32")
+    except Exception as e:
+        print(f"Warning: intent examples could not be embedded, local intent matching disabled: {e}")
+        return None
+    faiss.normalize_L2(vectors)
+    index = faiss.IndexFlatIP(vectors.shape[1])
+    index.add(vectors)
+
+    accuracy, coverage = _leave_one_out_accuracy(index, vectors, labels)
+    use_vote = accuracy >= config.INTENT_KNN_MIN_ACCURACY
+    print(
+        f"Local intent check (leave-one-out): {accuracy:.0%} accurate on the "
+        f"{coverage:.0%} of examples it decides; kNN vote {'on' if use_vote else 'off'}."
+    )
+    return index, labels, use_vote
+
+
+def _decide_intent(scores, ids, labels: List[str], use_vote: bool) -> Optional[str]:
+    """
+    A near-exact nearest example wins outright; otherwise (if use_vote) a
+    similarity-weighted vote of the k nearest examples must give one intent
+    >= INTENT_MIN_PROBABILITY. None means unsure → LLM.
+    """
+    if not len(ids):
+        return None
+    top_score = scores[0]
+    if top_score >= config.INTENT_SIMILARITY_THRESHOLD:
+        return labels[ids[0]]
+    if not use_vote or top_score < config.INTENT_KNN_MIN_SIMILARITY:
+        return None
+
+    votes: Dict[str, float] = {}
+    for score, idx in zip(scores, ids):
+        if idx >= 0 and score > 0:
+            votes[labels[idx]] = votes.get(labels[idx], 0.0) + float(score)
+    if not votes:
+        return None
+    best = max(votes, key=votes.get)
+    if votes[best] / sum(votes.values()) >= config.INTENT_MIN_PROBABILITY:
+        return best
+    return None
+
+
+def _leave_one_out_accuracy(index, vectors: np.ndarray, labels: List[str]) -> Tuple[float, float]:
+    """
+    Held-out check of the thresholds: classifies every example against all
+    the others. Returns (accuracy on the examples it decides, share decided);
+    accuracy is 0 when it decides none.
+    """
+    k = min(config.INTENT_KNN_K, index.ntotal - 1)
+    if k < 1:
+        return 0.0, 0.0
+    scores, ids = index.search(vectors, k + 1)
+    decided = correct = 0
+    for i, (row_scores, row_ids) in enumerate(zip(scores, ids)):
+        keep = row_ids != i
+        predicted = _decide_intent(row_scores[keep][:k], row_ids[keep][:k], labels, use_vote=True)
+        if predicted is not None:
+            decided += 1
+            correct += predicted == labels[i]
+    if not decided:
+        return 0.0, 0.0
+    return correct / decided, decided / len(labels)
+
+
+def _match_intent_locally(query_norm: str) -> Optional[str]:
+    """Local intent classifier over the intent.json examples (see _decide_intent)."""
+    if not query_norm:
+        return None
+    intent_index = _intent_index()
+    if intent_index is None:
+        return None
+    index, labels, use_vote = intent_index
+    try:
+        vec = np.asarray(rag_processor.get_embeddings().embed_documents([query_norm]), dtype="float32")
+        faiss.normalize_L2(vec)
+        scores, ids = index.search(vec, min(config.INTENT_KNN_K, index.ntotal))
+    except Exception as e:
+        print(f"Warning: local intent match failed, using LLM: {e}")
+        return None
+    return _decide_intent(scores[0], ids[0], labels, use_vote)
+
+
+def _local_intent(query: str, use_examples: bool) -> Optional[Dict[str, Any]]:
+    query_norm = query.lower().strip()
+    if _GREETING_RE.match(query_norm):
+        return {"intent": "greeting"}
+
+    local_intent = _match_intent_locally(query_norm) if use_examples else None
+    if local_intent:
+        return {"intent": local_intent}
+    return None
+
+
+def _intent_inputs(query: str, history: List[Dict[str, str]]) -> Dict[str, str]:
+    recent = history[-config.INTENT_HISTORY_WINDOW:]
+    history_str = "\n".join([f"{msg['role']}: {msg['content']}" for msg in recent])
+    return {"history": history_str, "query": query}
+
+
+def detect_intent_with_llm(query: str, history: List[Dict[str, str]], use_local: bool = True) -> Dict[str, Any]:
+    """
+    Detects intent: greeting regex → nearest intent.json examples
+    (embeddings) → LLM with recent history, only on a miss.
+    use_local=False skips the example match, for turns whose meaning
+    depends on the previous message (the match ignores history).
+    """
+    local = _local_intent(query, use_local)
+    if local:
+        return local
+
+    response = _cached_invoke("intent", intent_chain, _intent_inputs(query, history))
+    intent_data = parse_llm_json_output(response)
+    if "error" not in intent_data and intent_data.get("intent") not in _INTENT_LABELS:
+        # Truncated or invented label → same as unparseable output
+        print(f"Warning: unknown intent from LLM: {intent_data}")
+        return {"error": "Unknown intent", "details": intent_data}
+    return intent_data
 
 # --- 2. EMI Schedule Service (Requirement 5) ---
 def get_emi_schedule_from_gemini(principal: float, roi: float, tenure: int) -> Dict[str, Any]:
@@ -75,10 +330,7 @@ def get_emi_schedule_from_gemini(principal: float, roi: float, tenure: int) -> D
 # --- 3. Eligibility Check Service (Requirement 7, 13) ---
 def check_eligibility_with_gemini(data: Dict[str, Any]) -> Dict[str, Any]:
     """Calls Gemini to perform a soft sanction check."""
-    prompt_template = ChatPromptTemplate.from_template(prompts.ELIGIBILITY_PROMPT)
-    chain = prompt_template | llm | StrOutputParser()
-    
-    response = chain.invoke(data)
+    response = _cached_invoke("eligibility", eligibility_chain, data)
     json_response = parse_llm_json_output(response)
     
     if "error" in json_response:
@@ -88,26 +340,43 @@ def check_eligibility_with_gemini(data: Dict[str, Any]) -> Dict[str, Any]:
     return json_response
 
 # --- 4. RAG Response Service ---
-def get_rag_response(query: str, context: str) -> str:
-    """Generates a RAG response based on query and context."""
-    prompt_template = ChatPromptTemplate.from_template(prompts.RAG_PROMPT)
-    chain = prompt_template | llm | StrOutputParser()
-    
-    response = chain.invoke({
-        "context": context,
-        "query": query
-    })
+def get_rag_response(query: str, context: str, cacheable: bool = True) -> str:
+    """
+    Generates a RAG response based on query and context.
+    cacheable=False (context is a retrieval-failure fallback) bypasses llm_cache.
+    """
+    inputs = {"context": context, "query": query}
+    if not cacheable:
+        return rag_chain.invoke(inputs)
+    response = _cached_invoke("rag", rag_chain, inputs)
     
     return response
 
-def classify_emi_input(query: str, waiting_for: str) -> str:
+def stream_rag_response(query: str, context: str, cacheable: bool = True) -> Iterator[str]:
     """
-    Classifies EMI input:
-    - 'value' → user is giving principal/tenure/ROI
-    - 'other' → user is asking a general question
+    Same as get_rag_response, but yields the answer as it is generated.
+    The chunks are buffered and the full text goes into llm_cache under
+    the same key, so either variant can serve the other's cache hits.
     """
+    inputs = {"context": context, "query": query}
+    if not cacheable:
+        yield from rag_chain.stream(inputs)
+        return
+
+    key = LLMCache.cache_key("rag", inputs)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        yield cached
+        return
 
-    prompt = f"""
+    parts = []
+    for chunk in rag_chain.stream(inputs):
+        parts.append(chunk)
+        yield chunk
+    llm_cache.set(key, "".join(parts))
+
+def _emi_classifier_prompt(query: str, waiting_for: str) -> str:
+    return f"""
 You are an EMI input classifier.
 
 The user is expected to provide: {waiting_for}
@@ -121,27 +390,9 @@ User message: "{query}"
 Output ONLY one word: value or other
 """
 
-    # 🔥 Use SAME pattern as your other LLM calls
-    chain = (
-        ChatPromptTemplate.from_template("{prompt}")
-        | llm
-        | StrOutputParser()
-    )
-
-    result = chain.invoke({"prompt": prompt}).strip().lower()
 
-    return "value" if "value" in result else "other"
-
-
-
-def classify_eligibility_input(query: str, field: str) -> str:
-    """
-    Classifies if the user message is:
-    - 'value'  → user is giving the requested number
-    - 'other'  → user is asking a question or talking about something else
-    """
-
-    prompt = f"""
+def _eligibility_classifier_prompt(query: str, field: str) -> str:
+    return f"""
 You are an input classifier for home loan eligibility.
 
 The expected field is: {field}
@@ -157,11 +408,47 @@ User message: "{query}"
 Output ONLY one word: value or other
 """
 
-    chain = (
-        ChatPromptTemplate.from_template("{prompt}")
-        | llm
-        | StrOutputParser()
+
+# Short replies with a parseable number and no question words are values
+_QUESTION_HINT_RE = re.compile(r"\?|what|how|why|can|should|explain|tell")
+
+
+def _is_plain_value(query: str) -> bool:
+    return (
+        utils.parse_number_from_string(query) is not None
+        and len(query.split()) <= 4
+        and not _QUESTION_HINT_RE.search(query.lower())
+    )
+
+
+def _llm_value_or_other(name: str, prompt: str, key_inputs: Dict[str, Any]) -> str:
+    result = _cached_invoke(name, classifier_chain, {"prompt": prompt}, key_inputs=key_inputs)
+    return "value" if "value" in result.strip().lower() else "other"
+
+
+def classify_emi_input(query: str, waiting_for: str) -> str:
+    """
+    Classifies EMI input:
+    - 'value' → user is giving principal/tenure/ROI
+    - 'other' → user is asking a general question
+    """
+    if _is_plain_value(query):
+        return "value"
+    return _llm_value_or_other(
+        "classify_emi", _emi_classifier_prompt(query, waiting_for),
+        {"query": query, "waiting_for": waiting_for}
     )
 
-    result = chain.invoke({"prompt": prompt}).strip().lower()
-    return "value" if "value" in result else "other"
+
+def classify_eligibility_input(query: str, field: str) -> str:
+    """
+    Classifies if the user message is:
+    - 'value'  → user is giving the requested number
+    - 'other'  → user is asking a question or talking about something else
+    """
+    if _is_plain_value(query):
+        return "value"
+    return _llm_value_or_other(
+        "classify_eligibility", _eligibility_classifier_prompt(query, field),
+        {"query": query, "field": field}
+    )
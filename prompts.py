@@ -13,6 +13,11 @@ except FileNotFoundError:
 # =====================================================================================
 # PERSONA PROMPT
 # =====================================================================================
+# Every prompt below keeps its static text first and per-request variables
+# ({history}, {query}, {context}, ...) at the very end. Note the shared
+# prefixes (~700 tokens for intent, less for the others) are below Gemini 2.5
+# Flash's 1024-token minimum for implicit caching, so no prefix is cached
+# today; the ordering only pays off if a prompt grows past that minimum.
 
 PERSONA_PROMPT = """
 You are "RBL Bank Home Loan Assistant", a professional, helpful, and polite AI chatbot.
@@ -45,12 +50,6 @@ You are the Intent Classifier. Your job is to analyze:
 
 and classify it into ONE predefined intent.
 
-Conversation History:
-{{history}}
-
-Latest Query:
-"{{query}}"
-
 Predefined Intents (with examples):
 {json.dumps(INTENT_EXAMPLES, indent=2).replace("{", "{{").replace("}", "}}")}
 
@@ -61,6 +60,12 @@ Do NOT add any explanation.
 Example Response:
 {{{{"intent": "start_emi"}}}}
 
+Conversation History:
+{{history}}
+
+Latest Query:
+"{{query}}"
+
 JSON Output:
 """
 
@@ -73,14 +78,6 @@ ELIGIBILITY_PROMPT = """
 You are an RBL Bank Home Loan underwriter AI.
 Your job is to calculate a soft sanction loan amount using FOIR + EMI logic.
 
-User Data:
-- Income: {{income}}
-- Expense: {{expense}}
-- Employment Type: {{employment_type}}
-- DOB: {{dob}}
-- Pin Code: {{pin_code}}
-- Loan Type: {{loan_type}}
-
 ---------------------------------------
 FOLLOW THESE RULES STRICTLY
 ---------------------------------------
@@ -123,6 +120,14 @@ RETURN JSON ONLY IN THIS FORMAT:
   "reason": "explanation"  
 }}
 ---------------------------------------
+
+User Data:
+- Income: {{income}}
+- Expense: {{expense}}
+- Employment Type: {{employment_type}}
+- DOB: {{dob}}
+- Pin Code: {{pin_code}}
+- Loan Type: {{loan_type}}
 """
 
 
@@ -1,11 +1,18 @@
 # rag_processor.py
 import os
+import uuid
+import hashlib
+import faiss
+import numpy as np
 import streamlit as st
-from typing import List
+from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
 
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 
@@ -25,24 +32,137 @@ def _validate_google_credentials():
         )
 
 
+@st.cache_resource(show_spinner=False)
+def get_embeddings() -> GoogleGenerativeAIEmbeddings:
+    """Embeddings client, created once per process (SERVICE ACCOUNT ONLY!)."""
+    return GoogleGenerativeAIEmbeddings(
+        model=config.EMBEDDING_MODEL,
+        credentials=credentials
+    )
+
+
+def _index_fingerprint() -> str:
+    """
+    Identifies the on-disk index: embedding model, chunking settings and
+    each PDF's mtime/size. Any change forces a rebuild.
+    """
+    h = hashlib.sha256()
+    h.update(f"{config.EMBEDDING_MODEL}|{config.RAG_CHUNK_SIZE}|{config.RAG_CHUNK_OVERLAP}".encode())
+    h.update(f"|hnsw:{config.FAISS_HNSW_M}:{config.FAISS_HNSW_EF_CONSTRUCTION}:{config.FAISS_QUANTIZATION}".encode())
+    for pdf in config.PDF_FILES:
+        if os.path.exists(pdf):
+            info = os.stat(pdf)
+            h.update(f"|{pdf}:{info.st_mtime_ns}:{info.st_size}".encode())
+        else:
+            h.update(f"|{pdf}:missing".encode())
+    return h.hexdigest()
+
+
+def _load_persisted_index(embeddings, fingerprint: str):
+    """Returns the saved FAISS store if it matches the fingerprint, else None."""
+    index_dir = config.FAISS_INDEX_DIR
+    version_file = os.path.join(index_dir, "version.txt")
+    if not os.path.exists(os.path.join(index_dir, "index.faiss")) or not os.path.exists(version_file):
+        return None
+    try:
+        with open(version_file, encoding="utf-8") as f:
+            if f.read().strip() != fingerprint:
+                return None
+        # The index is written by this app only, so the pickle docstore is trusted
+        vectorstore = FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+        vectorstore.index.hnsw.efSearch = config.FAISS_HNSW_EF_SEARCH
+        return vectorstore
+    except Exception as e:
+        print(f"Persisted FAISS index unusable, rebuilding: {e}")
+        return None
+
+
+def _persist_index(vectorstore, fingerprint: str):
+    """Saves the store and its fingerprint; failures only cost a rebuild next start."""
+    try:
+        vectorstore.save_local(config.FAISS_INDEX_DIR)
+        with open(os.path.join(config.FAISS_INDEX_DIR, "version.txt"), "w", encoding="utf-8") as f:
+            f.write(fingerprint)
+    except Exception as e:
+        print(f"Could not persist FAISS index: {e}")
+
+
+# Scalar quantizers for the stored vectors (config.FAISS_QUANTIZATION)
+_SQ_TYPES = {
+    "fp16": faiss.ScalarQuantizer.QT_fp16,
+    "8bit": faiss.ScalarQuantizer.QT_8bit,
+}
+
+
+def _build_hnsw_store(texts: List[str], vectors: List[List[float]], metadatas: List[dict], embeddings) -> FAISS:
+    """
+    Builds the store on an HNSW graph index instead of the default flat
+    index, so search cost grows ~log(N) rather than linearly with chunks.
+    Vectors are stored fp16/int8 when FAISS_QUANTIZATION is set.
+    """
+    # FAISS takes float32 input; the quantizer decides the stored width
+    matrix = np.asarray(vectors, dtype="float32")
+    d = matrix.shape[1]
+    qtype = _SQ_TYPES.get(config.FAISS_QUANTIZATION)
+    if qtype is None:
+        index = faiss.IndexHNSWFlat(d, config.FAISS_HNSW_M)
+    else:
+        index = faiss.IndexHNSWSQ(d, qtype, config.FAISS_HNSW_M)
+        index.train(matrix)
+    index.hnsw.efConstruction = config.FAISS_HNSW_EF_CONSTRUCTION
+    index.add(matrix)
+    index.hnsw.efSearch = config.FAISS_HNSW_EF_SEARCH
+
+    ids = [str(uuid.uuid4()) for _ in texts]
+    docstore = InMemoryDocstore({
+        doc_id: Document(page_content=text, metadata=meta)
+        for doc_id, text, meta in zip(ids, texts, metadatas)
+    })
+    return FAISS(embeddings, index, docstore, dict(enumerate(ids)))
+
+
+def _load_pdf(pdf: str) -> Tuple[str, list, Exception | None]:
+    """Worker-thread PDF load; errors are returned so st.* stays on the main thread."""
+    try:
+        return pdf, PyPDFLoader(pdf).load(), None
+    except Exception as e:
+        return pdf, [], e
+
+
 @st.cache_resource(show_spinner="Loading RBL knowledge base…")
 def load_rag_vector_db():
     """Loads PDFs, splits them, embeds, and builds FAISS store."""
     # Validate credentials
     _validate_google_credentials()
 
-    docs = []
+    # --- Create Embeddings (SERVICE ACCOUNT ONLY!) ---
+    try:
+        embeddings = get_embeddings()
+    except Exception as e:
+        st.error(f"❌ Embedding initialization failed: {e}")
+        return None
+
+    # --- Reuse the index from disk when the PDFs are unchanged ---
+    fingerprint = _index_fingerprint()
+    vectorstore = _load_persisted_index(embeddings, fingerprint)
+    if vectorstore is not None:
+        print("FAISS vector store loaded from disk.")
+        return vectorstore
+
+    pdfs = []
     for pdf in config.PDF_FILES:
         if not os.path.exists(pdf):
             st.warning(f"⚠ PDF missing: {pdf} — skipping.")
             continue
+        pdfs.append(pdf)
 
-        try:
-            loader = PyPDFLoader(pdf)
-            pdf_docs = loader.load()
+    # --- Load PDFs in parallel (I/O bound) ---
+    docs = []
+    with ThreadPoolExecutor(max_workers=min(8, len(pdfs) or 1)) as ex:
+        for pdf, pdf_docs, err in ex.map(_load_pdf, pdfs):
+            if err is not None:
+                st.error(f"PDF Load error [{pdf}]: {err}")
             docs.extend(pdf_docs)
-        except Exception as e:
-            st.error(f"PDF Load error [{pdf}]: {e}")
 
     if not docs:
         st.error("❌ No documents loaded for RAG.")
@@ -55,43 +175,68 @@ def load_rag_vector_db():
     )
     split_docs = splitter.split_documents(docs)
 
-    # --- Create Embeddings (SERVICE ACCOUNT ONLY!) ---
+    # --- Build FAISS Vectorstore (embed in large batches, HNSW index) ---
     try:
-        
-        embeddings = GoogleGenerativeAIEmbeddings(
-            model=config.EMBEDDING_MODEL,
-            credentials=credentials
+        texts = [d.page_content for d in split_docs]
+        vectors = embeddings.embed_documents(texts, batch_size=config.RAG_EMBED_BATCH_SIZE)
+        vectorstore = _build_hnsw_store(
+            texts,
+            vectors,
+            [d.metadata for d in split_docs],
+            embeddings
         )
-    except Exception as e:
-        st.error(f"❌ Embedding initialization failed: {e}")
-        return None
-
-    # --- Build FAISS Vectorstore ---
-    try:
-        vectorstore = FAISS.from_documents(split_docs, embeddings)
         print("FAISS vector store loaded successfully.")
+        _persist_index(vectorstore, fingerprint)
         return vectorstore
     except Exception as e:
         st.error(f"❌ Failed to build FAISS store: {e}")
         return None
 
 
+@st.cache_data(ttl=config.RAG_CONTEXT_CACHE_TTL_SECONDS, max_entries=1024, show_spinner=False)
+def _retrieve_cached(query_norm: str, top_k: int, _vector_db) -> str:
+    """
+    Embeds the query and runs the similarity search; returns the joined
+    context string ("" when nothing matched) so st.cache_data can keep it.
+    _vector_db is the single st.cache_resource store, hence not hashed.
+    """
+    results = _vector_db.similarity_search(query_norm, k=top_k)
+    # Chunks mostly share a handful of source PDFs
+    src_names = {}
+    context_str = "\n\n---\n\n".join(
+        f"[From {_source_name(doc.metadata.get('source', ''), src_names)}]\n{doc.page_content}"
+        for doc in results
+    )
+    return context_str
+
+
+def _source_name(src: str, cache: dict) -> str:
+    name = cache.get(src)
+    if name is None:
+        name = cache[src] = os.path.basename(src)
+    return name
+
+
+class RetrievalUnavailable(Exception):
+    """No usable context for the query; str(e) is the fallback text for the LLM."""
+
+
 def get_retrieved_context(query: str, vector_db) -> str:
-    """Returns combined context for RAG answer generation."""
+    """
+    Returns combined context for RAG answer generation.
+    Raises RetrievalUnavailable when there is none (no knowledge base,
+    retrieval error, nothing matched), so callers can tell it apart.
+    """
     if vector_db is None:
-        return "Knowledge base unavailable."
+        raise RetrievalUnavailable("Knowledge base unavailable.")
 
+    query_norm = " ".join(query.lower().split())
     try:
-        results = vector_db.similarity_search(query, k=config.RAG_TOP_K)
+        context_str = _retrieve_cached(query_norm, config.RAG_TOP_K, vector_db)
     except Exception as e:
-        return f"RAG retrieval error: {e}"
+        raise RetrievalUnavailable(f"RAG retrieval error: {e}") from e
 
-    if not results:
-        return "No relevant context found."
+    if not context_str:
+        raise RetrievalUnavailable("No relevant context found.")
 
-    # Combine
-    context_str = "\n\n---\n\n".join(
-        [f"[From {os.path.basename(doc.metadata.get('source', ''))}]\n{doc.page_content}"
-         for doc in results]
-    )
     return context_str
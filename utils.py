@@ -1,13 +1,20 @@
 import re
 import json
+import math
 from typing import Dict, Any, List
 import streamlit as st
+import numpy as np
 import datetime
 from google.cloud import bigquery
 import config
 import random
 import os
 import smtplib
+import queue
+import threading
+import time
+import atexit
+import functools
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
@@ -15,24 +22,13 @@ from email.mime.multipart import MIMEMultipart
 # ============================================================
 # 🔢 INDIAN NUMBER FORMATTER
 # ============================================================
-def format_indian_style(number: float) -> str:
-    s = str(int(number))
-    if len(s) <= 3:
-        return s
-
-    last_three = s[-3:]
-    remaining = s[:-3]
-    formatted_remaining = ""
+# A comma goes after every digit that is followed by pairs of digits
+# and then the final group of three (12,34,56,789)
+_INDIAN_GROUP_RE = re.compile(r"(\d)(?=(?:\d\d)*\d{3}$)")
 
-    while remaining:
-        if len(remaining) > 2:
-            formatted_remaining = remaining[-2:] + ',' + formatted_remaining
-            remaining = remaining[:-2]
-        else:
-            formatted_remaining = remaining + ',' + formatted_remaining
-            remaining = ""
 
-    return formatted_remaining.rstrip(',') + ',' + last_three
+def format_indian_style(number: float) -> str:
+    return _INDIAN_GROUP_RE.sub(r"\1,", str(int(number)))
 
 
 # ============================================================
@@ -101,6 +97,29 @@ def _convert_session_to_int(session_id: str) -> int:
 # ============================================================
 # 🗄️ SAVE TO BIGQUERY  (CONTINUOUS + UPSERT)
 # ============================================================
+try:
+    import orjson   # optional: much faster JSON encoding of the growing chat history
+except ImportError:
+    orjson = None
+
+
+def _to_json(obj: Any, indent: bool = False) -> str:
+    """UTF-8 JSON text (non-ASCII kept as-is); orjson when installed."""
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_INDENT_2 if indent else 0)
+        try:
+            return orjson.dumps(obj, option=option).decode()
+        except TypeError:
+            pass   # type orjson can't encode → stdlib below
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_bigquery_client() -> bigquery.Client:
+    """One client (and HTTP session) reused for every save."""
+    return bigquery.Client(project=config.BIGQUERY_PROJECT_ID)
+
+
 def save_to_bigquery(
     session_id: str,
     chat_history: List[Dict[str, Any]],
@@ -114,7 +133,7 @@ def save_to_bigquery(
     - 'conversation' column always holds full chat_history JSON.
     """
 
-    client = bigquery.Client(project=config.BIGQUERY_PROJECT_ID)
+    client = _get_bigquery_client()
     dataset = config.BIGQUERY_DATASET
 
     tbl_conv = f"{dataset}.tbl_conversation"
@@ -123,7 +142,7 @@ def save_to_bigquery(
     session_int = _convert_session_to_int(session_id)
 
     # Full chat history JSON (assistant + user messages)
-    conversation_json = json.dumps(chat_history, indent=2, ensure_ascii=False)
+    conversation_json = _to_json(chat_history, indent=True)
 
     # Extracted data JSON payload
     extracted_payload = {
@@ -137,13 +156,18 @@ def save_to_bigquery(
         "email": app_state.get("email"),
         "phone_number": app_state.get("phone"),
     }
-    extracted_data_json = json.dumps(extracted_payload, ensure_ascii=False)
+    extracted_data_json = _to_json(extracted_payload)
 
     # --------------------------------------------------------
+    # One script job, one transaction (one job start per save):
     # 1) UPSERT CONVERSATION TABLE
     #    - time_stamp column is DATETIME in your schema
+    # 2) UPSERT EXTRACTED DATA TABLE
+    #    - keeps latest customer_name/email/phone/extracted_data
     # --------------------------------------------------------
-    query1 = f"""
+    script = f"""
+    BEGIN TRANSACTION;
+
     MERGE `{tbl_conv}` T
     USING (
       SELECT
@@ -158,24 +182,8 @@ def save_to_bigquery(
         T.time_stamp = S.time_stamp
     WHEN NOT MATCHED THEN
       INSERT (session_id, conversation, time_stamp)
-      VALUES (S.session_id, S.conversation, S.time_stamp)
-    """
-
-    job_config1 = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("session_id", "INT64", session_int),
-            bigquery.ScalarQueryParameter("conversation", "STRING", conversation_json),
-        ]
-    )
-
-    client.query(query1, job_config=job_config1).result()
-    print("✅ Conversation UPSERTED to BigQuery")
+      VALUES (S.session_id, S.conversation, S.time_stamp);
 
-    # --------------------------------------------------------
-    # 2) UPSERT EXTRACTED DATA TABLE
-    #    - keeps latest customer_name/email/phone/extracted_data
-    # --------------------------------------------------------
-    query2 = f"""
     MERGE `{tbl_extract}` T
     USING (
       SELECT
@@ -194,12 +202,15 @@ def save_to_bigquery(
         T.extracted_data = S.extracted_data
     WHEN NOT MATCHED THEN
       INSERT (session_id, customer_name, email, phone_number, extracted_data)
-      VALUES (S.session_id, S.customer_name, S.email, S.phone_number, S.extracted_data)
+      VALUES (S.session_id, S.customer_name, S.email, S.phone_number, S.extracted_data);
+
+    COMMIT TRANSACTION;
     """
 
-    job_config2 = bigquery.QueryJobConfig(
+    job_config = bigquery.QueryJobConfig(
         query_parameters=[
             bigquery.ScalarQueryParameter("session_id", "INT64", session_int),
+            bigquery.ScalarQueryParameter("conversation", "STRING", conversation_json),
             bigquery.ScalarQueryParameter(
                 "customer_name", "STRING", app_state.get("customer_name")
             ),
@@ -215,8 +226,79 @@ def save_to_bigquery(
         ]
     )
 
-    client.query(query2, job_config=job_config2).result()
-    print("✅ Extracted data UPSERTED to BigQuery")
+    client.query(script, job_config=job_config).result()
+    print("✅ Conversation + extracted data UPSERTED to BigQuery")
+
+
+# ============================================================
+# 🧵 BACKGROUND BIGQUERY WRITER (off the chat request path)
+# ============================================================
+_BQ_QUEUE: "queue.Queue[tuple]" = queue.Queue()
+_BQ_WORKER: threading.Thread | None = None
+_BQ_WORKER_LOCK = threading.Lock()
+_BQ_MAX_ATTEMPTS = 3
+_BQ_FLUSH_SECONDS = 2.0
+
+
+def _save_with_retry(session_id: str, chat_history, app_state):
+    for attempt in range(1, _BQ_MAX_ATTEMPTS + 1):
+        try:
+            save_to_bigquery(session_id, chat_history, app_state)
+            return
+        except Exception as e:
+            print(f"BigQuery save failed (attempt {attempt}/{_BQ_MAX_ATTEMPTS}): {e}")
+            if attempt < _BQ_MAX_ATTEMPTS:
+                time.sleep(2 ** attempt)
+
+
+def _bigquery_worker():
+    while True:
+        batch = [_BQ_QUEUE.get()]
+        # Let a burst of turns accumulate, then drain everything queued.
+        # MERGE rewrites the whole session row, so only the newest
+        # snapshot per session needs to be written.
+        time.sleep(_BQ_FLUSH_SECONDS)
+        while True:
+            try:
+                batch.append(_BQ_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+
+        latest = {item[0]: item for item in batch}
+        try:
+            for session_id, chat_history, app_state in latest.values():
+                _save_with_retry(session_id, chat_history, app_state)
+        finally:
+            for _ in batch:
+                _BQ_QUEUE.task_done()
+
+
+def _ensure_bigquery_worker():
+    global _BQ_WORKER
+    with _BQ_WORKER_LOCK:
+        if _BQ_WORKER is None or not _BQ_WORKER.is_alive():
+            _BQ_WORKER = threading.Thread(
+                target=_bigquery_worker, name="bigquery-writer", daemon=True
+            )
+            _BQ_WORKER.start()
+
+
+def enqueue_save_to_bigquery(
+    session_id: str,
+    chat_history: List[Dict[str, Any]],
+    app_state: Dict[str, Any]
+):
+    """
+    Non-blocking save_to_bigquery:
+    - Snapshots history/state so later turns don't mutate the payload.
+    - A daemon worker performs the MERGEs with retry/backoff.
+    """
+    _ensure_bigquery_worker()
+    _BQ_QUEUE.put_nowait((session_id, list(chat_history), dict(app_state)))
+
+
+# Flush pending saves before the Streamlit process exits
+atexit.register(_BQ_QUEUE.join)
 
 
 # ============================================================
@@ -246,33 +328,31 @@ def compute_emi_schedule(principal: float, annual_rate_percent: float, tenure_ye
 
     monthly_emi_round = round(monthly_emi, 2)
 
-    schedule = []
-    remaining = P
-    total_interest, total_payment = 0, 0
-
-    for month in range(1, n + 1):
-        interest = remaining * r
-        principal_component = monthly_emi - interest
-        if principal_component > remaining:
-            principal_component = remaining
-            payment = principal_component + interest
-        else:
-            payment = monthly_emi
-
-        remaining -= principal_component
-        if remaining < 1e-8:
-            remaining = 0.0
-
-        total_interest += interest
-        total_payment += payment
-
-        schedule.append({
-            "month": month,
-            "emi": round(payment, 2),
-            "principal_component": round(principal_component, 2),
-            "interest_component": round(interest, 2),
-            "remaining_principal": round(remaining, 2)
-        })
+    # Closed-form balance after k payments (k = 0..n), no per-month loop
+    k = np.arange(n + 1)
+    if r == 0:
+        balances = P - monthly_emi * k
+    else:
+        growth = (1 + r) ** k
+        balances = P * growth - monthly_emi * (growth - 1) / r
+
+    opening = balances[:-1]
+    interest = opening * r
+    principal_component = np.minimum(monthly_emi - interest, opening)
+    payment = principal_component + interest
+    remaining = opening - principal_component
+    remaining = np.where(remaining < 1e-8, 0.0, remaining)
+
+    total_interest = float(interest.sum())
+    total_payment = float(payment.sum())
+
+    # Round all columns in one vector op, then emit plain-Python rows
+    keys = ("emi", "principal_component", "interest_component", "remaining_principal")
+    columns = np.round(np.vstack((payment, principal_component, interest, remaining)), 2)
+    schedule = [
+        {"month": month, **dict(zip(keys, row))}
+        for month, row in enumerate(columns.T.tolist(), start=1)
+    ]
 
     if schedule:
         schedule[-1]["remaining_principal"] = 0.0
@@ -292,6 +372,18 @@ def compute_emi_schedule(principal: float, annual_rate_percent: float, tenure_ye
 # EMAIL OTP SENDER (GMAIL SMTP)
 # ============================================================
 def send_fake_otp_to_email(email: str, otp_code: str):
+    """
+    Sends the OTP email in a background thread so the chat turn doesn't
+    wait on SMTP. Safe because verification only compares against the
+    OTP stored in state, never against delivery.
+    """
+    threading.Thread(
+        target=_send_otp_email, args=(email, otp_code), name="otp-email", daemon=True
+    ).start()
+    return True
+
+
+def _send_otp_email(email: str, otp_code: str):
     sender = os.getenv("SENDER_EMAIL")
     password = os.getenv("SENDER_APP_PASSWORD")
 
@@ -319,27 +411,25 @@ def send_fake_otp_to_email(email: str, otp_code: str):
 # ============================================================
 # SOFT SANCTION (FOIR / EMI-BASED)
 # ============================================================
-def compute_soft_sanction(income, expense, employment_type, dob, roi=8.5):
-    import datetime as _dt
-
-    year = int(dob.split("-")[0])
-    current_year = _dt.datetime.now().year
-    age = current_year - year
+def _core_sanction(nmi: float, foir_factor: float, max_tenure: int, roi: float) -> float:
+    """Closed-form reverse EMI: the loan whose EMI equals the FOIR share of NMI."""
+    eligible_emi = nmi * foir_factor
+    r = roi / 100 / 12
+    n = max_tenure * 12
+    pow_val = math.pow(1 + r, n)
+    return eligible_emi * (pow_val - 1) / (r * pow_val)
 
-    max_tenure = min(60 - age, 30)
-    if max_tenure < 1:
-        return 0
 
+def compute_soft_sanction(income, expense, employment_type, dob, roi=8.5):
     nmi = income - expense
     if nmi <= 0:
         return 0
 
-    foir_factor = 0.50 if employment_type.lower() == "salaried" else 0.40
-    eligible_emi = nmi * foir_factor
-
-    r = roi / 100 / 12
-    n = max_tenure * 12
-    pow_val = (1 + r) ** n
+    # dob is YYYY-MM-DD
+    age = datetime.date.today().year - int(dob[:4])
+    max_tenure = min(60 - age, 30)
+    if max_tenure < 1:
+        return 0
 
-    loan_amt = eligible_emi * (pow_val - 1) / (r * pow_val)
-    return round(loan_amt, 2)
+    foir_factor = 0.50 if employment_type.lower() == "salaried" else 0.40
+    return round(_core_sanction(nmi, foir_factor, max_tenure, roi), 2)